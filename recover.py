@@ -1,71 +1,349 @@
 import argparse
-import requests
-from msal import PublicClientApplication
-from msgraph_core import BaseGraphRequestAdapter
+import email.utils
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
 
 # These values can be obtained from your app registration
 CLIENT_ID = "YOUR_CLIENT_ID"
 TENANT_ID = "consumers"  # Use 'consumers' for personal accounts
 SCOPES = ['Files.ReadWrite']
 
+# Tokens are cached here so later runs can skip the interactive login
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "recoverlette")
+TOKEN_CACHE_FILE = os.path.join(CACHE_DIR, "token_cache.json")
+# Downloaded templates, revalidated against OneDrive by ETag on each run
+TEMPLATE_CACHE_DIR = os.path.join(CACHE_DIR, "templates")
+
+# Graph rejects simple uploads above 4 MB; larger files need an upload session
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 10 * 320 * 1024  # must be a multiple of 320 KiB
+
+MAX_ATTEMPTS = 5
+RETRY_STATUS_CODES = (429, 503)
+MAX_RETRY_DELAY = 60  # seconds; never block the CLI longer than this per retry
+
+# LibreOffice binary used by --local-convert
+SOFFICE = "soffice"
+
+logger = logging.getLogger(__name__)
+
+_PLACEHOLDER_RE = re.compile(rb"\{\{(COMPANY|ATTN_NAME|ATTN_TITLE)\}\}")
+# Parts of a .docx that hold document text; everything else is copied as-is
+_TEXT_PART_RE = re.compile(r"word/(document|header\d*|footer\d*)\.xml")
+
+_app = None
+_token_cache = None
+
+def get_app():
+    global _app, _token_cache
+    if _app is None:
+        from msal import PublicClientApplication, SerializableTokenCache
+        _token_cache = SerializableTokenCache()
+        if os.path.exists(TOKEN_CACHE_FILE):
+            with open(TOKEN_CACHE_FILE) as f:
+                try:
+                    _token_cache.deserialize(f.read())
+                except ValueError:
+                    logger.warning("Ignoring unreadable token cache %s; you will be asked to log in", TOKEN_CACHE_FILE)
+                    _token_cache = SerializableTokenCache()
+        _app = PublicClientApplication(CLIENT_ID,
+                                       authority=f"https://login.microsoftonline.com/{TENANT_ID}",
+                                       token_cache=_token_cache)
+    return _app
+
+def save_token_cache():
+    if _token_cache is None or not _token_cache.has_state_changed:
+        return
+    # The cache holds refresh tokens; mkstemp creates the file readable by the user only
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        replace_cache_file(TOKEN_CACHE_FILE, _token_cache.serialize().encode())
+    except OSError as e:
+        logger.warning("Could not save token cache: %s", e)
+
 def authenticate():
-    app = PublicClientApplication(CLIENT_ID, authority=f"https://login.microsoftonline.com/{TENANT_ID}")
-    result = app.acquire_token_interactive(scopes=SCOPES)
+    app = get_app()
+    result = None
+    # Reuse a cached token (refreshed silently if needed) before prompting
+    accounts = app.get_accounts()
+    if accounts:
+        result = app.acquire_token_silent(SCOPES, account=accounts[0])
+    if not result:
+        result = app.acquire_token_interactive(scopes=SCOPES)
+    save_token_cache()
     if "access_token" in result:
         return result['access_token']
     else:
-        print(result.get("error"))
-        print(result.get("error_description"))
-        print(result.get("correlation_id"))
+        logger.error("%s: %s (correlation id: %s)",
+                     result.get("error"), result.get("error_description"), result.get("correlation_id"))
         return None
 
-def get_file_content(access_token, file_path):
-    graph_client = BaseGraphRequestAdapter(credential=access_token)
-    drive_item = graph_client.get(f"/me/drive/root:/{file_path}")
-    if drive_item.status_code == 200:
-        file_content = graph_client.get(f"/me/drive/items/{drive_item.data['id']}/content")
+def encode_path(file_path):
+    return urllib.parse.quote(file_path.lstrip('/'), safe='/')
+
+def parse_retry_after(retry_after):
+    # Retry-After may be a number of seconds or an HTTP-date
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return (retry_at - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(response, attempt):
+    delay = None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        delay = parse_retry_after(retry_after)
+    # Reject nan/inf, which time.sleep cannot handle
+    if delay is None or not math.isfinite(delay):
+        delay = 2 ** attempt
+    return min(max(delay, 0), MAX_RETRY_DELAY)
+
+def with_retry(request, *args, **kwargs):
+    for attempt in range(MAX_ATTEMPTS):
+        response = request(*args, **kwargs)
+        if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_ATTEMPTS - 1:
+            return response
+        # Graph says how long to back off when throttling; otherwise double each time
+        delay = retry_delay(response, attempt)
+        logger.warning("Throttled (%s), retrying in %gs", response.status_code, delay)
+        time.sleep(delay)
+
+def template_cache_paths(file_path):
+    key = hashlib.sha256(encode_path(file_path).encode()).hexdigest()
+    base = os.path.join(TEMPLATE_CACHE_DIR, key)
+    return base + ".etag", base + ".docx"
+
+def read_cache_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def replace_cache_file(path, data):
+    # Write to a temporary name and rename, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def drop_cached_template(file_path):
+    for path in template_cache_paths(file_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def save_cached_template(file_path, etag, content):
+    etag_path, content_path = template_cache_paths(file_path)
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    # Retire the old ETag before touching the content, then publish the new one last
+    drop_cached_template(file_path)
+    replace_cache_file(content_path, content)
+    replace_cache_file(etag_path, etag.encode())
+
+# Address items by path so each transfer is a single request (no id lookup)
+def get_file_content(graph_client, file_path):
+    url = f"/me/drive/root:/{encode_path(file_path)}:/content"
+    etag_path, content_path = template_cache_paths(file_path)
+    etag = read_cache_file(etag_path)
+    try:
+        etag = etag.decode() if etag else None
+    except UnicodeDecodeError:
+        # A damaged ETag file is just a cache miss
+        etag = None
+    headers = {"If-None-Match": etag} if etag else {}
+    file_content = with_retry(graph_client.get, url, headers=headers)
+    if file_content.status_code == 304:
+        cached_content = read_cache_file(content_path)
+        if cached_content is not None:
+            logger.info("Template unchanged, using cached copy")
+            return cached_content
+        logger.warning("Cached template is missing, downloading it again")
+        drop_cached_template(file_path)
+        file_content = with_retry(graph_client.get, url, headers={})
+    if file_content.status_code == 200:
+        new_etag = file_content.headers.get("ETag")
+        if new_etag:
+            try:
+                save_cached_template(file_path, new_etag, file_content.content)
+            except OSError as e:
+                logger.warning("Could not cache template: %s", e)
         return file_content.content
     else:
-        print(f"Error: {drive_item.status_code}")
+        logger.error("Error: %s", file_content.status_code)
         return None
 
-def update_file_content(access_token, file_path, content):
-    graph_client = BaseGraphRequestAdapter(credential=access_token)
-    drive_item = graph_client.get(f"/me/drive/root:/{file_path}")
-    if drive_item.status_code == 200:
-        update_response = graph_client.put(f"/me/drive/items/{drive_item.data['id']}/content",
-                                           data=content,
-                                           headers={"Content-type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"})
-        if update_response.status_code == 200:
-            print("File updated successfully")
-        else:
-            print(f"Error updating file: {update_response.status_code}")
+def cancel_upload_session(upload_url):
+    import requests
+
+    # Cancel the session so the partial upload does not linger on the server
+    try:
+        requests.delete(upload_url)
+    except requests.RequestException as e:
+        logger.warning("Could not cancel upload session: %s", e)
+
+def upload_large_file(graph_client, file_path, content):
+    # Only needed for upload sessions, so keep it off the startup path
+    import requests
+
+    session = with_retry(graph_client.post, f"/me/drive/root:/{encode_path(file_path)}:/createUploadSession",
+                         data=json.dumps({"item": {"@microsoft.graph.conflictBehavior": "replace"}}),
+                         headers={"Content-type": "application/json"})
+    if session.status_code != 200:
+        return session
+    upload_url = session.data['uploadUrl']
+    total = len(content)
+    # Fragments must be sent in order; the upload URL is pre-authenticated
+    for start in range(0, total, UPLOAD_CHUNK_SIZE):
+        chunk = content[start:start + UPLOAD_CHUNK_SIZE]
+        end = start + len(chunk) - 1
+        try:
+            response = with_retry(requests.put, upload_url,
+                                  data=chunk,
+                                  headers={"Content-Range": f"bytes {start}-{end}/{total}"})
+        except requests.RequestException as e:
+            logger.error("Upload of bytes %d-%d of %d failed: %s", start, end, total, e)
+            cancel_upload_session(upload_url)
+            return None
+        if response.status_code not in (200, 201, 202):
+            logger.error("Upload of bytes %d-%d of %d failed: %s", start, end, total, response.status_code)
+            cancel_upload_session(upload_url)
+            break
+    return response
+
+def update_file_content(graph_client, file_path, content):
+    if len(content) > SIMPLE_UPLOAD_LIMIT:
+        update_response = upload_large_file(graph_client, file_path, content)
+    else:
+        update_response = with_retry(graph_client.put, f"/me/drive/root:/{encode_path(file_path)}:/content",
+                                     data=content,
+                                     headers={"Content-type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"})
+    if update_response is None:
+        logger.error("Error updating file")
+    elif update_response.status_code in (200, 201):
+        logger.info("File updated successfully")
     else:
-        print(f"Error: {drive_item.status_code}")
+        logger.error("Error updating file: %s", update_response.status_code)
+
+def substitute(data, values):
+    # A plain substring test is much cheaper than a regex scan
+    if b"{{" not in data:
+        return data
+    return _PLACEHOLDER_RE.sub(lambda m: values[m.group(1)], data)
 
 def replace_placeholders(content, company, attn_name, attn_title):
-    content = content.replace(b"{{COMPANY}}", company.encode())
-    content = content.replace(b"{{ATTN_NAME}}", attn_name.encode())
-    content = content.replace(b"{{ATTN_TITLE}}", attn_title.encode())
-    return content
+    values = {
+        b"COMPANY": company.encode(),
+        b"ATTN_NAME": attn_name.encode(),
+        b"ATTN_TITLE": attn_title.encode(),
+    }
+    source = io.BytesIO(content)
+    if not zipfile.is_zipfile(source):
+        return substitute(content, values)
+
+    xml_values = {key: escape(value.decode()).encode() for key, value in values.items()}
+    with zipfile.ZipFile(source) as zin:
+        # Substitute in the text parts first; without placeholders the template is returned as-is
+        rewritten = {}
+        for item in zin.infolist():
+            if _TEXT_PART_RE.fullmatch(item.filename):
+                data = zin.read(item)
+                if b"{{" in data:
+                    rewritten[item.filename] = substitute(data, xml_values)
+        if not rewritten:
+            return content
+
+        # Rebuild the archive; other entries are streamed across with their original
+        # compression settings (zipfile cannot copy compressed data verbatim)
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, "w") as zout:
+            for item in zin.infolist():
+                if item.filename in rewritten:
+                    zout.writestr(item, rewritten[item.filename])
+                else:
+                    with zin.open(item) as src, zout.open(item, "w") as dst:
+                        shutil.copyfileobj(src, dst)
+    return output.getvalue()
 
-def main(input_file, company, attn_name, attn_title, output_file):
+def convert_to_pdf_locally(content, output_file):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        docx_path = os.path.join(tmp_dir, "letter.docx")
+        with open(docx_path, "wb") as f:
+            f.write(content)
+        pdf_path = os.path.join(tmp_dir, "letter.pdf")
+        # A private profile keeps a running LibreOffice from swallowing the request
+        profile = pathlib.Path(tmp_dir, "profile").as_uri()
+        try:
+            result = subprocess.run([SOFFICE, f"-env:UserInstallation={profile}", "--headless",
+                                     "--convert-to", "pdf", "--outdir", tmp_dir, docx_path],
+                                    capture_output=True)
+        except FileNotFoundError:
+            logger.error("Error: %s not found; install LibreOffice to use --local-convert", SOFFICE)
+            return
+        if result.returncode != 0 or not os.path.exists(pdf_path):
+            logger.error("Error converting to PDF: %s",
+                         result.stderr.decode(errors='replace').strip() or "no PDF was produced")
+            return
+        try:
+            shutil.move(pdf_path, output_file)
+        except OSError as e:
+            logger.error("Error saving PDF to %s: %s", output_file, e)
+            return
+    logger.info("PDF saved to %s", output_file)
+
+def main(input_file, company, attn_name, attn_title, output_file, local_convert=False):
     access_token = authenticate()
     if not access_token:
-        print("Authentication failed")
+        logger.error("Authentication failed")
         return
 
+    # One client for all requests so the connection is reused
+    from msgraph_core import BaseGraphRequestAdapter
+    graph_client = BaseGraphRequestAdapter(credential=access_token)
+
     # Get the content of the input file
-    file_content = get_file_content(access_token, input_file)
+    file_content = get_file_content(graph_client, input_file)
     if not file_content:
-        print("Failed to retrieve file content")
+        logger.error("Failed to retrieve file content")
         return
 
     # Replace placeholders
     updated_content = replace_placeholders(file_content, company, attn_name, attn_title)
 
+    if local_convert:
+        # Render the PDF here instead of uploading the document back to OneDrive
+        convert_to_pdf_locally(updated_content, output_file)
+        return
+
     # Update the file with new content
-    update_file_content(access_token, output_file, updated_content)
+    update_file_content(graph_client, output_file, updated_content)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a customized cover letter")
@@ -74,7 +352,16 @@ if __name__ == "__main__":
     parser.add_argument("--attn_name", required=True, help="Attention name")
     parser.add_argument("--attn_title", required=True, help="Attention title")
     parser.add_argument("-o", "--output", required=True, help="Output file name")
+    parser.add_argument("--local-convert", action="store_true",
+                        help="Convert to PDF locally with LibreOffice and save it to OUTPUT instead of uploading")
 
     args = parser.parse_args()
 
-    main(args.input, args.company, args.attn_name, args.attn_title, args.output)
\ No newline at end of file
+    # Progress goes to stdout as before; warnings and errors go to stderr
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setLevel(logging.WARNING)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[stdout_handler, stderr_handler])
+
+    main(args.input, args.company, args.attn_name, args.attn_title, args.output, args.local_convert)
\ No newline at end of file